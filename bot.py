@@ -2,9 +2,14 @@ import asyncio
 import os
 import time
 import logging
-from typing import Dict, List, Tuple
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Tuple
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache, TTLCache
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.types import Message
 import database
@@ -21,38 +26,83 @@ if not BOT_TOKEN or not ADMIN_ID:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
+class KeepAliveSession(AiohttpSession):
+    """AiohttpSession with an explicitly sized, keep-alive friendly pool
+    so bursts (report copies, broadcasts) reuse TCP/TLS connections
+    instead of opening new ones."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(limit=128, limit_per_host=64, keepalive_timeout=75)
+
+
+bot = Bot(token=BOT_TOKEN, session=KeepAliveSession())
 dp = Dispatcher()
 
 # Initialize DB
 database.init_db()
 
+# --- DB access off the event loop ---
+# sqlite3 calls are blocking; run them in a dedicated worker thread so a
+# commit never stalls other users' handlers. One worker is enough because
+# SQLite serializes writes anyway.
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+async def _db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, fn, *args)
+
 # --- Last messages (for reports) ---
-last_messages: Dict[int, List[Tuple[int, int]]] = {}
+# Bounded LRU so a long-running bot doesn't accumulate an entry for every
+# user that ever wrote; each user keeps a deque capped at `limit` entries.
+last_messages: LRUCache = LRUCache(maxsize=10_000)
 
 def push_last_message(user_id: int, chat_id: int, message_id: int, limit: int = 5):
-    lst = last_messages.get(user_id, [])
+    lst: Deque[Tuple[int, int]] = last_messages.get(user_id) or deque(maxlen=limit)
     lst.append((chat_id, message_id))
-    if len(lst) > limit:
-        lst = lst[-limit:]
+    # Reassign so the entry is promoted to most-recently-used.
     last_messages[user_id] = lst
 
+# --- Outbound rate limiting ---
+# Telegram allows ~30 messages/sec globally and ~1 message/sec per chat;
+# pacing sends locally avoids RetryAfter errors and wasted retries.
+# Per-chat limiters live in a bounded LRU (like last_messages) so idle
+# chats don't accumulate limiter objects forever; an evicted limiter
+# just means that chat starts with a fresh 1/sec bucket next time.
+_global_limiter = AsyncLimiter(30, 1)
+_chat_limiters: LRUCache = LRUCache(maxsize=10_000)
+
+def _chat_limiter(chat_id: int) -> AsyncLimiter:
+    limiter = _chat_limiters.get(chat_id)
+    if limiter is None:
+        limiter = AsyncLimiter(1, 1)
+        _chat_limiters[chat_id] = limiter
+    return limiter
+
+async def send_limited(chat_id: int, text: str):
+    async with _global_limiter, _chat_limiter(chat_id):
+        return await bot.send_message(chat_id, text)
+
+async def copy_limited(chat_id: int, from_chat_id: int, message_id: int):
+    async with _global_limiter, _chat_limiter(chat_id):
+        return await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+
 async def notify_user(user_id: int, text: str):
     try:
-        await bot.send_message(user_id, text)
+        await send_limited(user_id, text)
     except Exception as e:
         logger.warning(f"Failed to send message to {user_id}: {e}")
 
 # --- Rate limiting ---
-last_action_time: Dict[str, float] = {}
+# One bucket of action timestamps per user id; avoids building and
+# hashing a "uid:action" string on every check.
+last_action_time: Dict[int, Dict[str, float]] = defaultdict(dict)
 
 def is_rate_limited(user_id: int, action: str, cooldown: int) -> bool:
     now = time.time()
-    key = f"{user_id}:{action}"
-    last_time = last_action_time.get(key, 0)
-    if now - last_time < cooldown:
+    bucket = last_action_time[user_id]
+    if now - bucket.get(action, 0) < cooldown:
         return True
-    last_action_time[key] = now
+    bucket[action] = now
     return False
 
 # --- Limits Settings ---
@@ -60,19 +110,53 @@ CHANNEL = "@nedo_dev"
 LIMIT = 5
 RESET_SECONDS = 3600
 
+# --- Static reply texts (built once, not per handler call) ---
+COMMANDS_TEXT = (
+    "📖 Available commands:\n"
+    "/start - Start the bot\n"
+    "/next - Find a chat partner\n"
+    "/stop - End the chat\n"
+    "/report - Report your partner to admin\n"
+    "/commands - Show this list of commands"
+)
+QUEUE_TEXT = (
+    "⏳ You have been added to the queue. Please wait for a partner.\n\n"
+    "Available commands:\n"
+    "/stop - leave the queue\n"
+    "/report - report your partner\n"
+    "/next - find a new partner\n"
+    "/commands - show all commands"
+)
+LIMIT_REACHED_TEXT = (
+    f"⛔ You have used {LIMIT} searches this hour.\n\n"
+    f"👉 Subscribe to our channel to remove the limit: {CHANNEL}"
+)
+
 # --- Check subscription ---
+# get_chat_member is a full API round-trip; remember positive answers for
+# a few minutes so repeated /next attempts by an over-limit user don't
+# re-check. Negatives are never cached: a user who just subscribed after
+# the limit prompt must pass on their very next attempt.
+_sub_cache: TTLCache = TTLCache(maxsize=100_000, ttl=300)
+
 async def is_subscribed(user_id: int, channel_username: str) -> bool:
+    key = (user_id, channel_username)
+    if _sub_cache.get(key):
+        return True
     try:
         member = await bot.get_chat_member(chat_id=channel_username, user_id=user_id)
-        return member.status in ["member", "administrator", "creator"]
+        subscribed = member.status in ["member", "administrator", "creator"]
     except Exception:
         return False
+    if subscribed:
+        _sub_cache[key] = True
+    return subscribed
 
 # --- Commands ---
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     user = message.from_user
-    database.add_user(user.id, user.username, user.first_name, user.last_name)
+    await _db(database.add_user, user.id, user.username, user.first_name, user.last_name)
     if database.is_blocked(user.id):
         await message.answer("You are blocked and cannot use the bot.")
         return
@@ -80,15 +164,7 @@ async def cmd_start(message: Message):
 
 @dp.message(Command("commands"))
 async def show_commands(message: Message):
-    commands_text = (
-        "📖 Available commands:\n"
-        "/start - Start the bot\n"
-        "/next - Find a chat partner\n"
-        "/stop - End the chat\n"
-        "/report - Report your partner to admin\n"
-        "/commands - Show this list of commands"
-    )
-    await message.answer(commands_text)
+    await message.answer(COMMANDS_TEXT)
 
 @dp.message(Command("next"))
 async def cmd_next(message: Message):
@@ -99,8 +175,6 @@ async def cmd_next(message: Message):
         await message.answer("⏳ Please wait a few seconds before using /next again.")
         return
 
-    database.add_user(uid, user.username, user.first_name, user.last_name)
-
     if database.is_blocked(uid):
         await message.answer("You are blocked and cannot use this feature.")
         return
@@ -118,47 +192,38 @@ async def cmd_next(message: Message):
                 premium = 1
                 await message.answer("✅ You are subscribed to our channel! The limit has been completely removed. 🚀")
             else:
-                await message.answer(
-                    f"⛔ You have used {LIMIT} searches this hour.\n\n"
-                    f"👉 Subscribe to our channel to remove the limit: {CHANNEL}"
-                )
-                database.update_limit(uid, used, reset_time, premium)
+                await message.answer(LIMIT_REACHED_TEXT)
+                await _db(database.next_turn, uid, user.username, user.first_name, user.last_name,
+                          used, reset_time, premium)
                 return
 
     if not premium:
         used += 1
 
-    database.update_limit(uid, used, reset_time, premium)
-
     partner = database.get_partner(uid)
+    candidate = database.pop_from_queue(exclude_user_id=uid)
+
+    # One transaction covers the user upsert, limit update and chat changes.
+    await _db(database.next_turn, uid, user.username, user.first_name, user.last_name,
+              used, reset_time, premium, partner, candidate)
+
     if partner:
-        database.remove_chat_by_users(uid, partner)
         await notify_user(partner, "🔴 Your partner has left the chat.")
         await message.answer("🔴 You left the chat. Searching for a new partner...")
 
-    candidate = database.get_first_in_queue(exclude_user_id=uid)
     if candidate:
-        database.remove_from_queue(candidate)
-        database.add_chat(uid, candidate)
         await notify_user(candidate, "🔗 Partner found! Type /commands to see options.")
         await message.answer("🔗 Partner found! Type /commands to see options.")
     else:
         database.add_to_queue(uid)
-        await message.answer(
-            "⏳ You have been added to the queue. Please wait for a partner.\n\n"
-            "Available commands:\n"
-            "/stop - leave the queue\n"
-            "/report - report your partner\n"
-            "/next - find a new partner\n"
-            "/commands - show all commands"
-        )
+        await message.answer(QUEUE_TEXT)
 
 @dp.message(Command("stop"))
 async def cmd_stop(message: Message):
     uid = message.from_user.id
     partner = database.get_partner(uid)
     if partner:
-        database.remove_chat_by_users(uid, partner)
+        await _db(database.remove_chat_by_users, uid, partner)
         await notify_user(partner, "🔴 Your partner ended the chat (/stop).")
         await message.answer("🔴 You ended the chat.\n\nType /commands to see available options.")
     else:
@@ -173,28 +238,33 @@ async def cmd_report(message: Message):
         await message.answer("You are not in a chat, nothing to report.")
         return
 
-    database.add_report(reporter, partner)
+    await _db(database.add_report, reporter, partner)
     await message.answer("✅ Report sent to admin. Thank you!")
 
     msgs = last_messages.get(partner, [])
     if not msgs:
-        await bot.send_message(ADMIN_ID, f"Report from {reporter} about {partner}. No messages found.")
+        await send_limited(ADMIN_ID, f"Report from {reporter} about {partner}. No messages found.")
         return
 
-    await bot.send_message(ADMIN_ID, f"📣 Report from {reporter} about {partner}. Last partner messages (up to 5):")
-    for (from_chat_id, message_id) in msgs:
-        try:
-            await bot.copy_message(chat_id=ADMIN_ID, from_chat_id=from_chat_id, message_id=message_id)
-        except Exception as e:
-            logger.warning(f"Failed to copy message {message_id} from {from_chat_id} to admin: {e}")
-    await bot.send_message(ADMIN_ID, f"End of report. Reporter: {reporter}, Reported: {partner}")
+    await send_limited(ADMIN_ID, f"📣 Report from {reporter} about {partner}. Last partner messages (up to 5):")
+    # Fire all copies at once; the per-chat limiter paces them to the
+    # admin chat and any individual failure is logged below.
+    results = await asyncio.gather(
+        *[copy_limited(ADMIN_ID, from_chat_id, message_id)
+          for (from_chat_id, message_id) in msgs],
+        return_exceptions=True,
+    )
+    for (from_chat_id, message_id), result in zip(msgs, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to copy message {message_id} from {from_chat_id} to admin: {result}")
+    await send_limited(ADMIN_ID, f"End of report. Reporter: {reporter}, Reported: {partner}")
 
 @dp.message(Command("stats"))
 async def cmd_stats(message: Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("This command is only available to the admin.")
         return
-    stats = database.get_stats()
+    stats = await _db(database.get_stats)
     text = (
         f"📊 Stats:\n"
         f"- Users in DB: {stats['users']}\n"
@@ -218,10 +288,10 @@ async def cmd_block(message: Message):
     except ValueError:
         await message.answer("Invalid user_id.")
         return
-    database.block_user(user_id)
+    await _db(database.block_user, user_id)
     partner = database.get_partner(user_id)
     if partner:
-        database.remove_chat_by_users(user_id, partner)
+        await _db(database.remove_chat_by_users, user_id, partner)
         await notify_user(partner, "🔴 Your partner was blocked by the admin.")
     database.remove_from_queue(user_id)
     await notify_user(user_id, "You have been blocked. You cannot use the bot.")
@@ -241,7 +311,7 @@ async def cmd_unblock(message: Message):
     except ValueError:
         await message.answer("Invalid user_id.")
         return
-    database.unblock_user(user_id)
+    await _db(database.unblock_user, user_id)
     await notify_user(user_id, "You have been unblocked. You can use the bot again.")
     await message.answer(f"User {user_id} unblocked.")
 
@@ -260,24 +330,43 @@ async def handle_text(message: Message):
     push_last_message(uid, message.chat.id, message.message_id, limit=5)
 
     try:
-        await bot.send_message(partner_id, message.text)
+        await send_limited(partner_id, message.text)
     except Exception as e:
         logger.warning(f"Failed to send text to {partner_id}: {e}")
         await message.answer("Failed to deliver the message.")
 
 # --- Block all media ---
-@dp.message(F.content_type.in_({"photo", "video", "voice", "audio", "sticker", "document"}))
+# Attribute checks are cheaper than matching content_type strings
+# against a set on every update.
+@dp.message(F.photo | F.video | F.voice | F.audio | F.sticker | F.document)
 async def block_media(message: Message):
     await message.answer("🚫 Only text messages are allowed.")
 
 # --- Startup/Shutdown ---
+_flusher_task = None
+
+async def _limits_flusher(interval: int = 10):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await _db(database.flush_limits)
+        except Exception as e:
+            logger.warning(f"Failed to flush limits: {e}")
+
 async def on_startup():
+    # Keep a reference so the task isn't garbage-collected mid-flight.
+    global _flusher_task
+    _flusher_task = asyncio.create_task(_limits_flusher())
     logger.info("Bot started")
 
 async def on_shutdown():
+    await _db(database.flush_limits)
     await bot.session.close()
     logger.info("Bot stopped")
 
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
 # --- Minimal web server for Render ---
 async def handle(request):
     return web.Response(text="OK")
@@ -296,10 +385,15 @@ async def start_web_server():
 # --- Main ---
 async def main():
     await start_web_server()
-    loop = asyncio.get_event_loop()
-    loop.create_task(dp.start_polling(bot, on_startup=on_startup, on_shutdown=on_shutdown))
-    while True:
-        await asyncio.sleep(3600)
+    # Await polling directly: it runs until cancelled, so no keepalive
+    # sleep loop is needed and polling exceptions propagate.
+    # Only message updates are handled, so don't ask Telegram for the rest;
+    # a long getUpdates timeout covers more messages per round-trip.
+    await dp.start_polling(
+        bot,
+        allowed_updates=["message"],
+        polling_timeout=50,
+    )
 
 if __name__ == "__main__":
     asyncio.run(main())
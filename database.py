@@ -1,11 +1,142 @@
+import collections
 import sqlite3
+import threading
 import time
+from contextlib import contextmanager
+from cachetools import LRUCache
 
 DB_NAME = "database.db"
 
+# Single long-lived connection: opening/closing + fsync per call dominates
+# the cost of every query, so connect once and let WAL handle concurrency.
+_conn = None
+_write_lock = threading.RLock()
+
+# In-memory mirrors of the small, rarely-mutated tables so the per-message
+# hot path (is_blocked/get_partner) never touches SQLite. Loaded in
+# init_db() and updated in lockstep with every write below.
+_blocked = set()
+_partner = {}
+
+# Bloom filter in front of _blocked: the common case (user not blocked)
+# is answered from a couple of bit probes without hashing into the set.
+# 2^23 bits (1 MiB) with two probes keeps the false-positive rate under
+# 1% up to roughly a million blocked ids; positives fall through to the
+# set, so the answer is always exact.
+_BLOOM_BITS = 1 << 23
+_bloom = bytearray(_BLOOM_BITS // 8)
+
+
+def _bloom_positions(user_id):
+    # splitmix64-style mix; the low and high halves give two probes.
+    x = user_id & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    x ^= x >> 31
+    return x & (_BLOOM_BITS - 1), (x >> 32) & (_BLOOM_BITS - 1)
+
+
+def _bloom_add(user_id):
+    for pos in _bloom_positions(user_id):
+        _bloom[pos >> 3] |= 1 << (pos & 7)
+
+
+def _bloom_rebuild():
+    # Bits can't be unset individually; rebuild on unblock (rare). Build
+    # into a fresh bytearray and swap the reference in one assignment so
+    # readers on other threads never see a partially filled filter.
+    global _bloom
+    new_bloom = bytearray(_BLOOM_BITS // 8)
+    for user_id in _blocked:
+        for pos in _bloom_positions(user_id):
+            new_bloom[pos >> 3] |= 1 << (pos & 7)
+    _bloom = new_bloom
+
+# The matchmaking queue is ephemeral, so it lives entirely in-process:
+# a deque for FIFO order plus a set for O(1) membership. pop_from_queue
+# finds and claims a candidate in one synchronous step with no awaits,
+# so under the single-threaded event loop two concurrent /next calls can
+# never pop the same candidate. Removal just drops the id from the set;
+# stale deque entries are skipped lazily.
+_queue = collections.deque()
+_queue_set = set()
+
+# Row counters kept in step with every insert so get_stats() never has
+# to scan a table; reconciled from COUNT(*) once at startup. Chat and
+# queue sizes come straight from the in-memory mirrors above.
+_counts = {"users": 0, "reports": 0}
+
+# Profile tuples of recently upserted users; lets add_user skip the
+# INSERT OR REPLACE entirely when nothing changed, which is the common
+# case for every /start and /next after the first.
+_seen_users = LRUCache(maxsize=50_000)
+
+# Per-user limit counters are authoritative in memory and written behind:
+# mutations land in _limits and mark the id dirty, and flush_limits()
+# (called periodically and on shutdown) bulk-upserts the dirty rows.
+_limits = {}
+_dirty_limits = set()
+
+# Hot-path SQL as module constants: sqlite3 caches prepared statements
+# keyed by the SQL text, so reusing the exact same string object skips
+# re-parsing the statement on every call.
+SQL_USER_EXISTS = "SELECT 1 FROM users WHERE user_id = ?"
+SQL_UPSERT_USER = """
+    INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_ADD_CHAT = "INSERT OR IGNORE INTO chats (user1_id, user2_id) VALUES (?, ?), (?, ?)"
+SQL_REMOVE_CHAT = "DELETE FROM chats WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)"
+SQL_ADD_REPORT = "INSERT INTO reports (reporter_id, reported_id, reason, timestamp) VALUES (?, ?, ?, ?)"
+SQL_BLOCK_USER = "INSERT OR IGNORE INTO blocks (user_id) VALUES (?)"
+SQL_UNBLOCK_USER = "DELETE FROM blocks WHERE user_id = ?"
+SQL_UPSERT_LIMIT = """
+    INSERT INTO limits (user_id, used_count, reset_time, premium)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        used_count=excluded.used_count,
+        reset_time=excluded.reset_time,
+        premium=excluded.premium
+"""
+
 
 def _connect():
-    return sqlite3.connect(DB_NAME)
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None,
+                                cached_statements=512)
+        # 8 KiB pages suit the tiny-row random-PK lookups here better than
+        # the 4 KiB default. The page size only takes effect via VACUUM and
+        # can't change while in WAL mode, so convert once before enabling it.
+        if _conn.execute("PRAGMA page_size").fetchone()[0] != 8192:
+            _conn.executescript("""
+                PRAGMA journal_mode=DELETE;
+                PRAGMA page_size=8192;
+                VACUUM;
+            """)
+        _conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+            PRAGMA mmap_size=268435456;
+            PRAGMA foreign_keys=ON;
+        """)
+    return _conn
+
+
+@contextmanager
+def transaction():
+    """Group several writes into one BEGIN...COMMIT, i.e. a single fsync."""
+    conn = _connect()
+    with _write_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
 
 def init_db():
@@ -22,14 +153,9 @@ def init_db():
     )
     """)
 
-    # --- Queue ---
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS queue (
-        user_id INTEGER PRIMARY KEY
-    )
-    """)
-
     # --- Chats ---
+    # Each chat is stored as two mirrored rows (a,b) and (b,a) so a
+    # partner lookup is always a single PK-prefix probe on user1_id.
     cur.execute("""
     CREATE TABLE IF NOT EXISTS chats (
         user1_id INTEGER,
@@ -65,167 +191,177 @@ def init_db():
     )
     """)
 
-    conn.commit()
-    conn.close()
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_limits_reset ON limits(reset_time)")
+
+    _blocked.clear()
+    _blocked.update(row[0] for row in cur.execute("SELECT user_id FROM blocks"))
+    _bloom_rebuild()
+
+    # Backfill mirror rows for chats written before normalization.
+    cur.execute("INSERT OR IGNORE INTO chats SELECT user2_id, user1_id FROM chats")
+
+    _partner.clear()
+    for user1_id, user2_id in cur.execute("SELECT user1_id, user2_id FROM chats"):
+        _partner[user1_id] = user2_id
+        _partner[user2_id] = user1_id
+
+    _counts["users"] = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    _counts["reports"] = cur.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+
+    _limits.clear()
+    for user_id, used_count, reset_time, premium in cur.execute(
+            "SELECT user_id, used_count, reset_time, premium FROM limits"):
+        _limits[user_id] = {"used_count": used_count, "reset_time": reset_time, "premium": premium}
+    _dirty_limits.clear()
 
 
 # ---------------- USERS ----------------
 def add_user(user_id, username, first_name, last_name):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("""
-    INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
-    VALUES (?, ?, ?, ?)
-    """, (user_id, username, first_name, last_name))
-    conn.commit()
-    conn.close()
+    profile = (username, first_name, last_name)
+    if _seen_users.get(user_id) == profile:
+        return
+    with _write_lock:
+        conn = _connect()
+        if conn.execute(SQL_USER_EXISTS, (user_id,)).fetchone() is None:
+            _counts["users"] += 1
+        conn.execute(SQL_UPSERT_USER, (user_id, username, first_name, last_name))
+        _seen_users[user_id] = profile
 
 
 # ---------------- QUEUE ----------------
 def add_to_queue(user_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO queue (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    if user_id not in _queue_set:
+        _queue.append(user_id)
+        _queue_set.add(user_id)
 
 
 def remove_from_queue(user_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM queue WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    _queue_set.discard(user_id)
 
 
-def get_first_in_queue(exclude_user_id=None):
-    conn = _connect()
-    cur = conn.cursor()
-    if exclude_user_id:
-        cur.execute("SELECT user_id FROM queue WHERE user_id != ? ORDER BY ROWID ASC LIMIT 1", (exclude_user_id,))
-    else:
-        cur.execute("SELECT user_id FROM queue ORDER BY ROWID ASC LIMIT 1")
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
+def pop_from_queue(exclude_user_id=None):
+    """Atomically pop the first waiting user. Tombstones are dropped,
+    the excluded id is scanned past without being consumed (it keeps its
+    FIFO position), and pop plus removal happen in one step so no
+    candidate can be handed to two callers."""
+    while _queue and _queue[0] not in _queue_set:
+        _queue.popleft()
+    for i, user_id in enumerate(_queue):
+        if user_id in _queue_set and user_id != exclude_user_id:
+            del _queue[i]
+            _queue_set.discard(user_id)
+            return user_id
+    return None
 
 
 # ---------------- CHATS ----------------
 def add_chat(user1_id, user2_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO chats (user1_id, user2_id) VALUES (?, ?)", (user1_id, user2_id))
-    conn.commit()
-    conn.close()
+    with _write_lock:
+        _connect().execute(SQL_ADD_CHAT, (user1_id, user2_id, user2_id, user1_id))
+        _partner[user1_id] = user2_id
+        _partner[user2_id] = user1_id
 
 
 def get_partner(user_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT user2_id FROM chats WHERE user1_id = ?", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        cur.execute("SELECT user1_id FROM chats WHERE user2_id = ?", (user_id,))
-        row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
+    return _partner.get(user_id)
 
 
 def remove_chat_by_users(user1_id, user2_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM chats WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user1_id, user2_id, user2_id, user1_id))
-    conn.commit()
-    conn.close()
+    with _write_lock:
+        _connect().execute(SQL_REMOVE_CHAT, (user1_id, user2_id, user2_id, user1_id))
+        _partner.pop(user1_id, None)
+        _partner.pop(user2_id, None)
 
 
 # ---------------- REPORTS ----------------
 def add_report(reporter_id: int, reported_id: int, reason: str = "No reason provided"):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO reports (reporter_id, reported_id, reason, timestamp) VALUES (?, ?, ?, ?)",
-                (reporter_id, reported_id, reason, int(time.time())))
-    conn.commit()
-    conn.close()
+    with _write_lock:
+        _connect().execute(SQL_ADD_REPORT, (reporter_id, reported_id, reason, int(time.time())))
+        _counts["reports"] += 1
 
 
 # ---------------- BLOCKS ----------------
 def block_user(user_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO blocks (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    with _write_lock:
+        _connect().execute(SQL_BLOCK_USER, (user_id,))
+        _blocked.add(user_id)
+        _bloom_add(user_id)
 
 
 def unblock_user(user_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM blocks WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with _write_lock:
+        _connect().execute(SQL_UNBLOCK_USER, (user_id,))
+        _blocked.discard(user_id)
+        _bloom_rebuild()
 
 
 def is_blocked(user_id):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM blocks WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return bool(row)
+    pos1, pos2 = _bloom_positions(user_id)
+    if not (_bloom[pos1 >> 3] >> (pos1 & 7)) & 1 or not (_bloom[pos2 >> 3] >> (pos2 & 7)) & 1:
+        return False
+    return user_id in _blocked
 
 
 # ---------------- LIMITS ----------------
 def get_limit_info(user_id: int):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT used_count, reset_time, premium FROM limits WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return {"used_count": row[0], "reset_time": row[1], "premium": row[2]} if row else {"used_count": 0, "reset_time": 0, "premium": 0}
+    info = _limits.get(user_id)
+    return dict(info) if info else {"used_count": 0, "reset_time": 0, "premium": 0}
 
 
 def update_limit(user_id: int, used_count: int, reset_time: int, premium: int):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO limits (user_id, used_count, reset_time, premium)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET 
-            used_count=excluded.used_count,
-            reset_time=excluded.reset_time,
-            premium=excluded.premium
-    """, (user_id, used_count, reset_time, premium))
-    conn.commit()
-    conn.close()
+    _limits[user_id] = {"used_count": used_count, "reset_time": reset_time, "premium": premium}
+    _dirty_limits.add(user_id)
+
+
+def flush_limits():
+    """Write-behind: bulk-upsert every dirty limit row in one transaction."""
+    if not _dirty_limits:
+        return
+    dirty = list(_dirty_limits)
+    _dirty_limits.clear()
+    rows = [(user_id, info["used_count"], info["reset_time"], info["premium"])
+            for user_id, info in ((uid, _limits[uid]) for uid in dirty)]
+    try:
+        with transaction() as cur:
+            cur.executemany(SQL_UPSERT_LIMIT, rows)
+    except Exception:
+        # Put the ids back so the next flush retries them.
+        _dirty_limits.update(dirty)
+        raise
+
+
+def next_turn(user_id, username, first_name, last_name, used_count, reset_time, premium,
+              old_partner=None, new_partner=None):
+    """Apply every write of a /next call at once: the limit update goes
+    to the write-behind store and the user upsert plus chat leave/join
+    share a single transaction."""
+    update_limit(user_id, used_count, reset_time, premium)
+    profile = (username, first_name, last_name)
+    upsert_user = _seen_users.get(user_id) != profile
+    with transaction() as cur:
+        if upsert_user:
+            if cur.execute(SQL_USER_EXISTS, (user_id,)).fetchone() is None:
+                _counts["users"] += 1
+            cur.execute(SQL_UPSERT_USER, (user_id, username, first_name, last_name))
+        if old_partner is not None:
+            cur.execute(SQL_REMOVE_CHAT, (user_id, old_partner, old_partner, user_id))
+        if new_partner is not None:
+            cur.execute(SQL_ADD_CHAT, (user_id, new_partner, new_partner, user_id))
+    # Update the in-memory mirrors only once the transaction committed.
+    if upsert_user:
+        _seen_users[user_id] = profile
+    if old_partner is not None:
+        _partner.pop(user_id, None)
+        _partner.pop(old_partner, None)
+    if new_partner is not None:
+        _partner[user_id] = new_partner
+        _partner[new_partner] = user_id
 
 
 def get_stats():
-    conn = _connect()
-    cur = conn.cursor()
-
-    # Users
-    cur.execute("SELECT COUNT(*) FROM users")
-    users_count = cur.fetchone()[0]
-
-    # Reports
-    cur.execute("SELECT COUNT(*) FROM reports")
-    reports_count = cur.fetchone()[0]
-
-    # Chats
-    cur.execute("SELECT COUNT(*) FROM chats")
-    chats_count = cur.fetchone()[0]
-
-    # Queue
-    cur.execute("SELECT COUNT(*) FROM queue")
-    queue_count = cur.fetchone()[0]
-
-    conn.close()
-
     return {
-        "users": users_count,
-        "reports": reports_count,
-        "active_chats": chats_count,
-        "queue": queue_count
+        "users": _counts["users"],
+        "reports": _counts["reports"],
+        "active_chats": len(_partner) // 2,
+        "queue": len(_queue_set)
     }